@@ -1,4 +1,4 @@
-#!/usr/bin/env python
+#!/usr/bin/env python3
 
 # Author: Mathias Hauan Arbo
 # Date: 25. September, 2017
@@ -11,82 +11,204 @@ produces a \"/meshes/\" folder. """
 
 import sys
 import csv
+import logging
+import hashlib
 import argparse
+import shlex
 import subprocess
+import concurrent.futures
+import tempfile
 import os
+import math
+import xml.etree.ElementTree as ET
+import numpy as np
 try:
     import FreeCAD
 except ImportError:
     if not os.path.exists("/usr/lib/freecad/lib/"):
-        # To cheat python 2/3 compatible input/output I'll just use
-        # sys.stdout/stdin directly
-        sys.stdout.write("FreeCAD not found at /usr/lib/freecad/lib/. Please"
-                         " specify path to freecad.\n")
-        # Python 2/3 compatible input handling
-        FREECADPATH = sys.stdin.readline()
-        if FREECADPATH[-1] == "\n":
-            FREECADPATH = FREECADPATH[:-1]
+        FREECADPATH = input("FreeCAD not found at /usr/lib/freecad/lib/. "
+                            "Please specify path to freecad.\n")
     else:
         # Ubuntu standard placement
         FREECADPATH = "/usr/lib/freecad/lib/"
     sys.path.append(FREECADPATH)
     import FreeCAD
 import Mesh
+import MeshPart
 import importDAE
 import importOBJ
 import Import as freecadimport  # Very unfortunate module name
 
+logger = logging.getLogger(__name__)
+# Folders this process has already created
+_made_dirs = set()
+# Digests of the cadfiles this process has read, keyed on
+# (path, mtime, size)
+_cadfile_digests = {}
+
+
+def makeDirs(path):
+    """Creates path and its parents, once per process."""
+    if path not in _made_dirs:
+        os.makedirs(path, exist_ok=True)
+        _made_dirs.add(path)
+
+
+def fileDigest(path):
+    """Returns a hex digest of the contents of the file at path."""
+    digest = hashlib.blake2b(digest_size=16)
+    with open(path, "rb") as ifile:
+        for chunk in iter(lambda: ifile.read(1 << 20), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def cadfileDigest(path):
+    """Returns fileDigest of the cadfile at path, only reading it once per
+    process as every exported part needs it.
+    """
+    stat = os.stat(path)
+    cache_key = (os.path.abspath(path), stat.st_mtime, stat.st_size)
+    if cache_key not in _cadfile_digests:
+        _cadfile_digests[cache_key] = fileDigest(path)
+    return _cadfile_digests[cache_key]
+
+
+def readStamp(stamp_path, ipaths, key):
+    """Returns the output path recorded in stamp_path if the stamp is
+    newer than all ipaths, was made with the same key, and the output
+    still exists. Otherwise returns None, also for a malformed stamp
+    left by an interrupted run.
+    """
+    if not os.path.exists(stamp_path):
+        return None
+    stamp_time = os.path.getmtime(stamp_path)
+    for ipath in ipaths:
+        if os.path.getmtime(ipath) > stamp_time:
+            return None
+    with open(stamp_path, "r") as ifile:
+        lines = ifile.read().split("\n")
+    if len(lines) < 2:
+        return None
+    stamp_key, opath = lines[:2]
+    if stamp_key != key or not opath or not os.path.exists(opath):
+        return None
+    return opath
+
+
+def writeStamp(stamp_path, key, opath):
+    """Records that opath was made with key, see readStamp."""
+    with open(stamp_path, "w") as ofile:
+        ofile.write(f"{key}\n{opath}\n")
+
 
 def executeMeshlabScript(imesh_path, script_path, omesh_path=None,
-                         optargs="-om vn fn", verbose=False):
+                         optargs="-om vn fn", verbose=False,
+                         use_cache=False):
     """Executes `meshlabserver -i imesh_path -s script_path -o
     omesh_path optargs.  If unspecified, omesh_path is in imesh_folder
-    and is named script_name.fileextension.
+    and is named script_name.fileextension. With use_cache, the call is
+    skipped if omesh_path was made from the same imesh_path contents,
+    script contents and optargs.
     Returns the path to the resulting mesh.
     """
-    # Path handling
-    script_name = os.path.splitext(os.path.split(script_path)[-1])[0]
-    imesh_file = os.path.split(imesh_path)[-1]
-    ext = os.path.splitext(imesh_file)[-1]
-    imeshfolder_path = os.path.split(imesh_path)[0]
+    # Path handling, the default name is only worked out when needed
     if not omesh_path:
+        script_name = os.path.splitext(os.path.split(script_path)[-1])[0]
+        imeshfolder_path, imesh_file = os.path.split(imesh_path)
+        ext = os.path.splitext(imesh_file)[-1]
         omesh_path = os.path.join(imeshfolder_path, script_name + ext)
     omeshfolder_path = os.path.split(omesh_path)[0]
-    if not os.path.exists(omeshfolder_path):
-        os.makedirs(omeshfolder_path)
+    makeDirs(omeshfolder_path)
+    # Skip if the previous run made the same mesh
+    stamp_path = f"{omesh_path}.stamp"
+    if use_cache:
+        # Keyed on contents, a re-exported but identical mesh is a hit
+        key = f"{fileDigest(imesh_path)} {fileDigest(script_path)} {optargs}"
+        if readStamp(stamp_path, [], key) == omesh_path:
+            logger.debug("Up to date: %s", omesh_path)
+            return omesh_path
+    logger.debug("Script %s on %s to %s", script_path, imesh_path,
+                 omesh_path)
+    # A failed run must not leave the old mesh behind looking new
+    for stale_path in (stamp_path, omesh_path):
+        if os.path.exists(stale_path):
+            os.remove(stale_path)
     # Calling the meshlabscript
+    argv = (["meshlabserver", "-i", imesh_path, "-o", omesh_path]
+            + shlex.split(optargs) + ["-s", script_path])
     if verbose:
-        temp = subprocess.check_output("meshlabserver -i " + imesh_path
-                                       + " -o " + omesh_path + " "
-                                       + optargs + " -s " + script_path,
-                                       shell=True)
-        sys.stdout.write(temp)
+        # Buffered pipe read, meshlabserver is chatty
+        temp = subprocess.check_output(argv, bufsize=-1)
+        sys.stdout.buffer.write(temp)
     else:
-        deadpipe = open(os.devnull, "w")
-        subprocess.call("meshlabserver -i " + imesh_path + " -o " + omesh_path
-                        + " " + optargs + " -s " + script_path,
-                        shell=True, stderr=deadpipe, stdout=deadpipe)
+        subprocess.check_call(argv, stderr=subprocess.DEVNULL,
+                              stdout=subprocess.DEVNULL)
+    if not os.path.isfile(omesh_path):
+        raise RuntimeError(f"meshlab script {script_path} did not write "
+                           f"{omesh_path}")
+    if use_cache:
+        writeStamp(stamp_path, key, omesh_path)
     return omesh_path
 
 
+def buildPipelineScript(stages, name="pipeline"):
+    """Writes a temporary meshlab script chaining the filters of each
+    (script_path, n_repeats) pair in stages, so meshlabserver only has to
+    be started once. Returns the path to the temporary script, remove it
+    when done.
+    """
+    root = ET.Element("FilterScript")
+    for script_path, n_repeats in stages:
+        if n_repeats < 1:
+            continue
+        filters = list(ET.parse(script_path).getroot())
+        for i in range(n_repeats):
+            root.extend(filters)
+    fd, tmp_path = tempfile.mkstemp(prefix=f"{name}_", suffix=".mlx")
+    with os.fdopen(fd, "wb") as ofile:
+        ofile.write(b"<!DOCTYPE FilterScript>\n")
+        ofile.write(ET.tostring(root))
+    return tmp_path
+
+
 def sanitizeAndPlace(func):
     """Sanitizes the output mesh path and places the object in local or
-    global frame."""
-    def function_wrapper(obj, omesh_path=None,
-                         use_global_frame=True):
+    global frame. If cadfile is given, the export is stamped with the
+    cadfile path and contents, frame and export options, and with
+    use_cache it is skipped when the previous export had the same stamp.
+    Other keyword arguments are passed on to the exporter."""
+    def function_wrapper(obj, omesh_path=None, use_global_frame=True,
+                         cadfile=None, use_cache=True, **kwargs):
         if not omesh_path:
             omeshfolder_path = os.path.join("./meshes/", obj.Label)
             omesh_path = os.path.join(omeshfolder_path, "full")
         else:
-            omeshfolder_path = os.split(omesh_path)[0]
-        if not os.path.exists(omeshfolder_path):
-            os.makedirs(omeshfolder_path)
+            omeshfolder_path = os.path.split(omesh_path)[0]
+        makeDirs(omeshfolder_path)
+        stamp_path = f"{omesh_path}.stamp"
+        if cadfile:
+            # Keyed on contents, an older copy of another cadfile with the
+            # same part labels must not reuse these meshes
+            key = (f"{func.__name__} {os.path.abspath(cadfile)} "
+                   f"{cadfileDigest(cadfile)} "
+                   f"use_global_frame={use_global_frame} "
+                   f"{sorted(kwargs.items())}")
+            if use_cache:
+                res = readStamp(stamp_path, [], key)
+                if res:
+                    return res
+        # The old stamp no longer describes the mesh about to be written
+        if os.path.exists(stamp_path):
+            os.remove(stamp_path)
         prev_pl = obj.Placement
         if not use_global_frame:
             pl = getGlobalPlacement(obj)
             obj.Placement = pl.inverse().multiply(obj.Placement)
-        res = func(obj, omesh_path)
+        res = func(obj, omesh_path, **kwargs)
         obj.Placement = prev_pl
+        if cadfile:
+            writeStamp(stamp_path, key, res)
         return res
     return function_wrapper
 
@@ -104,25 +226,123 @@ def getGlobalPlacement(obj):
     return pl
 
 
+def shapeFingerprint(shape):
+    """Placement independent key for a shape. Partner shapes share the
+    same topology, so they always get the same key and isPartner only has
+    to be checked within a bucket. Only exact counts are used, volume and
+    area are computed after the placement is applied and differ by float
+    noise between partners.
+    """
+    return (shape.ShapeType, len(shape.Vertexes), len(shape.Edges),
+            len(shape.Faces))
+
+
+def getUniqueParts(objs):
+    """Groups the Part::Feature objects in objs into partner shapes.
+    Returns a dict, in document order, from the label of the first object
+    of each group to that object and the [label, placement] pairs of all
+    objects in the group.
+    """
+    parts = {}
+    buckets = {}
+    for obj in objs:
+        if obj.TypeId != "Part::Feature":
+            continue
+        # Each property access goes through FreeCAD, only do it once
+        label, shape = obj.Label, obj.Shape
+        pair = [label, obj.Placement]
+        bucket = buckets.setdefault(shapeFingerprint(shape), [])
+        for ushape, placements in bucket:
+            if ushape.isPartner(shape):
+                placements.append(pair)
+                break
+        else:
+            placements = [pair]
+            bucket.append((shape, placements))
+            parts[label] = {
+                "obj": obj,
+                "placements": placements
+            }
+    return parts
+
+
 def savePlacements(labelplacementpairs, csvfilename):
     """Saves the placements in a list of placements to a csvfile."""
-    odir, ofilename = os.path.split(csvfilename)
-    if not os.path.exists(odir):
-        os.makedirs(odir)
-    with open(csvfilename, "wb") as ofile:
+    makeDirs(os.path.split(csvfilename)[0])
+    rows = [["Label",
+             "x [m]", "y [m]", "z [m]",
+             "axis_x", "axis_y", "axis_z",
+             "angle"]]
+    for label, pl in labelplacementpairs:
+        pos, R = pl.Base, pl.Rotation
+        axis = R.Axis
+        rows.append([label,
+                     pos.x*1e-3, pos.y*1e-3, pos.z*1e-3,
+                     axis.x, axis.y, axis.z,
+                     R.Angle])
+    with open(csvfilename, "w", 65536, newline="") as ofile:
         csvw = csv.writer(ofile, delimiter=",")
-        csvw.writerow(["Label",
-                       "x [m]", "y [m]", "z [m]",
-                       "axis_x", "axis_y", "axis_z",
-                       "angle"])
-        for pair in labelplacementpairs:
-            label = pair[0]
-            pl = pair[1]
-            pos, R = pl.Base, pl.Rotation
-            csvw.writerow([label,
-                           pos.x*1e-3, pos.y*1e-3, pos.z*1e-3,
-                           R.Axis.x, R.Axis.y, R.Axis.z,
-                           R.Angle])
+        csvw.writerows(rows)
+
+
+def savePlacementsNpy(labelplacementpairs, npyfilename):
+    """Saves the placements in a list of placements to a binary .npy
+    file. Each record holds the label, the position in meters, the
+    rotation axis and the rotation angle, like the csv columns.
+    """
+    makeDirs(os.path.split(npyfilename)[0])
+    labels = [label for label, pl in labelplacementpairs]
+    dtype = [("label", f"U{max(len(label) for label in labels)}"),
+             ("pos", "f8", 3), ("axis", "f8", 3), ("angle", "f8")]
+    data = np.empty(len(labelplacementpairs), dtype=dtype)
+    for i, (label, pl) in enumerate(labelplacementpairs):
+        pos, R = pl.Base, pl.Rotation
+        axis = R.Axis
+        data[i] = (label, (pos.x*1e-3, pos.y*1e-3, pos.z*1e-3),
+                   (axis.x, axis.y, axis.z), R.Angle)
+    np.save(npyfilename, data)
+
+
+def initMeshlabWorker(n_threads):
+    """Limits the OpenMP threads meshlab uses in this worker process, so
+    parallel workers don't oversubscribe the cores. meshlabserver
+    subprocesses inherit the setting through the environment.
+    """
+    os.environ["OMP_NUM_THREADS"] = str(n_threads)
+
+
+def processMeshlabStages(job):
+    """Runs the convex hull and simplification meshlab scripts on an
+    exported mesh. Only works on filesystem paths, so it can be run in a
+    worker process. A script path of None skips that stage. A failing
+    stage doesn't stop the others. Returns the label, the list of
+    generated meshes and a list of (mesh, error) pairs for failed stages.
+    """
+    label, meshpath, chull_script, simple_script, verbose, use_cache = job
+    meshfolder_path = os.path.split(meshpath)[0]
+    ext = os.path.splitext(meshpath)[-1]
+    stages = []
+    # Convex Hull
+    if chull_script:
+        chullpath = os.path.join(meshfolder_path, f"chull{ext}")
+        stages.append(("convex hull", chull_script, chullpath))
+    # Simplify base mesh
+    if simple_script:
+        simplepath = os.path.join(meshfolder_path, f"simple{ext}")
+        stages.append(("simplified model", simple_script, simplepath))
+    generated = []
+    failed = []
+    for name, script_path, omesh_path in stages:
+        try:
+            executeMeshlabScript(meshpath, script_path,
+                                 omesh_path=omesh_path, verbose=verbose,
+                                 use_cache=use_cache)
+        except (subprocess.CalledProcessError, RuntimeError,
+                OSError) as err:
+            failed.append((name, str(err)))
+        else:
+            generated.append(name)
+    return label, generated, failed
 
 
 @sanitizeAndPlace
@@ -159,17 +379,24 @@ def exportOBJ(obj, omesh_path):
 
 
 @sanitizeAndPlace
-def exportSTL(obj, omesh_path):
+def exportSTL(obj, omesh_path, tolerance=0.1):
     """
     Export ./\"meshfolder_path\"/\"Label\"/full.stl from the FreeCAD object.
-    Uses Mesh module and returns path to the STL.
+    Tessellates once with MeshPart using an absolute linear deflection of
+    tolerance mm, and returns path to the STL.
     """
     omesh_path += ".stl"
-    Mesh.export([obj], omesh_path)
+    mesh = MeshPart.meshFromShape(Shape=obj.Shape,
+                                  LinearDeflection=tolerance,
+                                  AngularDeflection=math.radians(5),
+                                  Relative=False)
+    mesh.write(omesh_path)
     return omesh_path
 
 
 if __name__ == "__main__":
+    # cpu_count can't always tell
+    n_cores = os.cpu_count() or 1
     parser = argparse.ArgumentParser(
         description="Convert step files into meshes. Exports all "
                     "parts as separate meshes, either with origin"
@@ -192,85 +419,152 @@ if __name__ == "__main__":
                              " \".amf\".",
                         default=".stl",
                         required=False)
+    parser.add_argument("-tol", "--tolerance",
+                        help="Absolute linear deflection in mm used when "
+                             "tessellating STL meshes (default: 0.1).",
+                        default=0.1, type=float,
+                        required=False)
+    parser.add_argument("-pf", "--placements-format",
+                        help="Default: \"csv\", or \"npy\" for a binary "
+                             "numpy record array.",
+                        default="csv", choices=["csv", "npy"],
+                        required=False)
     parser.add_argument("-g", "--use-design-global-origin",
                         help="Flag to use global origin.",
                         required=False,
                         action="store_true")
+    parser.add_argument("-j", "--jobs",
+                        help="Number of meshlab scripts to run in parallel "
+                             "(default: number of cores).",
+                        default=n_cores, type=int,
+                        required=False)
+    parser.add_argument("-f", "--force",
+                        help="Regenerate all meshes, even if they were "
+                             "made from the same cadfile and options.",
+                        required=False,
+                        action="store_true")
     parser.add_argument("-v", "--verbose",
-                        help="Print meshlabscript outputs.",
+                        help="Print meshlabscript calls and outputs.",
                         required=False,
                         action="store_true")
     args = parser.parse_args()
+    logging.basicConfig(format="%(message)s",
+                        level=logging.DEBUG if args.verbose else logging.INFO)
+    if args.jobs < 1:
+        parser.error(f"--jobs must be at least 1, got {args.jobs}")
+    # Meshlab scripts are taken from the working directory, check them
+    # before spending time on the cadfile
+    chull_mlx = os.path.abspath("chull.mlx")
+    simple_mlx = os.path.abspath("simple.mlx")
+    needed_scripts = []
+    if args.num_chull > 0:
+        needed_scripts.append(chull_mlx)
+    if args.num_chull > 1 or args.num_simplify > 0:
+        needed_scripts.append(simple_mlx)
+    for script_path in needed_scripts:
+        if not os.path.isfile(script_path):
+            parser.error(f"meshlab script {script_path} not found")
     # Open file
     doc = FreeCAD.newDocument("temp")
     FreeCAD.setActiveDocument("temp")
     freecadimport.insert(args.cadfile, "temp")
 
     # Gather the unique shapes, and clone parts
-    unique_objs = []
-    parts = {}
-    num_objs = 0
-    for obj in doc.Objects:
-        new_shape = True
-        if obj.TypeId == "Part::Feature":
-            num_objs += 1
-            for uobj in unique_objs:
-                if uobj.Shape.isPartner(obj.Shape):
-                    new_shape = False
-                    parts[uobj.Label]["placements"] += [[obj.Label,
-                                                         obj.Placement]]
-            if new_shape:
-                unique_objs.append(obj)
-                parts[obj.Label] = {
-                    "obj": obj,
-                    "placements": [[obj.Label, obj.Placement]]
-                }
-    sys.stdout.write("Found " + str(num_objs) + " where " +
-                     str(len(unique_objs)) + " are unique.\n")
-    sys.stdout.write("Mesh generation:\n")
+    parts = getUniqueParts(doc.Objects)
+    num_objs = sum(len(part["placements"]) for part in parts.values())
+    logger.info("Found %d where %d are unique.", num_objs, len(parts))
+    logger.info("Mesh generation:")
     globpl = args.use_design_global_origin
-    for uobj in unique_objs:
-        sys.stdout.write(uobj.Label+":\n")
-        # Export full mesh
-        if "stl" in args.file_extension.lower():
-            meshpath = exportSTL(uobj, use_global_frame=globpl)
-        elif "obj" in args.file_extension.lower():
-            meshpath = exportOBJ(uobj, use_global_frame=globpl)
-        elif "dae" in args.file_extension.lower():
-            meshpath = exportDAE(uobj, use_global_frame=globpl)
-        elif "amf" in args.file_extension.lower():
-            meshpath = exportAMF(uobj, use_global_frame=globpl)
-        else:
-            raise ValueError("Unknown file extension specified")
-        sys.stdout.write("\t-Mesh generated\n")
-        # Export placements
-        meshdir = os.path.split(meshpath)[0]
-        csvfilename = os.path.join(meshdir, "placements.csv")
-        savePlacements(parts[uobj.Label]["placements"], csvfilename)
-        nclones = len(parts[uobj.Label]["placements"])
-        if nclones > 1:
-            sys.stdout.write("\t-" + str(nclones-1) + " clones placed\n")
-        # Convex Hull
-        cwd = os.getcwd()
+    cadfile = args.cadfile
+    use_cache = not args.force
+    # The meshlab pipelines are the same for every object, build them once
+    chull_script = None
+    simple_script = None
+    pool = None
+    # Future of each object's meshlab stages, to its label
+    pending = {}
+    n_failed = 0
+    try:
         if args.num_chull > 0:
-            chullpath = executeMeshlabScript(meshpath,
-                                             os.path.join(cwd, "chull.mlx"),
-                                             verbose=args.verbose)
-            for i in range(1, args.num_chull):
-                executeMeshlabScript(chullpath,
-                                     os.path.join(cwd, "simple.mlx"),
-                                     omesh_path=chullpath,
-                                     verbose=args.verbose)
-            sys.stdout.write("\t-Generated convex hull\n")
-        # Simplify base mesh
+            chull_script = buildPipelineScript(
+                [(chull_mlx, 1), (simple_mlx, args.num_chull - 1)],
+                "chull")
         if args.num_simplify > 0:
-            simplepath = executeMeshlabScript(meshpath,
-                                              os.path.join(cwd, "simple.mlx"),
-                                              verbose=args.verbose)
-            for i in range(1, args.num_simplify):
-                executeMeshlabScript(simplepath,
-                                     os.path.join(cwd, "simple.mlx"),
-                                     simplepath,
-                                     verbose=args.verbose)
-            sys.stdout.write("\t-Generated simplified model\n")
-    sys.stdout.write("Note: Check chull and simplified meshes for issues!\n")
+            simple_script = buildPipelineScript(
+                [(simple_mlx, args.num_simplify)],
+                "simple")
+        # Meshlab workers run while FreeCAD exports the next object
+        n_threads = max(1, n_cores // args.jobs)
+        pool = concurrent.futures.ProcessPoolExecutor(
+            max_workers=args.jobs,
+            initializer=initMeshlabWorker,
+            initargs=(n_threads,))
+        file_extension = args.file_extension.lower()
+        for label, part in parts.items():
+            uobj, placements = part["obj"], part["placements"]
+            logger.info("%s:", label)
+            # Export full mesh
+            if "stl" in file_extension:
+                meshpath = exportSTL(uobj, use_global_frame=globpl,
+                                     cadfile=cadfile, use_cache=use_cache,
+                                     tolerance=args.tolerance)
+            elif "obj" in file_extension:
+                meshpath = exportOBJ(uobj, use_global_frame=globpl,
+                                     cadfile=cadfile,
+                                     use_cache=use_cache)
+            elif "dae" in file_extension:
+                meshpath = exportDAE(uobj, use_global_frame=globpl,
+                                     cadfile=cadfile,
+                                     use_cache=use_cache)
+            elif "amf" in file_extension:
+                meshpath = exportAMF(uobj, use_global_frame=globpl,
+                                     cadfile=cadfile,
+                                     use_cache=use_cache)
+            else:
+                raise ValueError("Unknown file extension specified")
+            logger.info("\t-Mesh generated")
+            # Export placements
+            meshdir = os.path.split(meshpath)[0]
+            if args.placements_format == "npy":
+                npyfilename = os.path.join(meshdir, "placements.npy")
+                savePlacementsNpy(placements, npyfilename)
+            else:
+                csvfilename = os.path.join(meshdir, "placements.csv")
+                savePlacements(placements, csvfilename)
+            nclones = len(placements)
+            if nclones > 1:
+                logger.info("\t-%d clones placed", nclones - 1)
+            # Meshlab stages only need the mesh path, start them right away
+            job = (label, meshpath, chull_script, simple_script,
+                   args.verbose, use_cache)
+            pending[pool.submit(processMeshlabStages, job)] = label
+        # FreeCAD is done, report the meshlab scripts as they finish
+        logger.info("Mesh processing:")
+        for future in concurrent.futures.as_completed(pending):
+            label = pending[future]
+            logger.info("%s:", label)
+            try:
+                _, generated, failed = future.result()
+            except Exception as err:
+                # The worker itself died, the other objects can still go on
+                logger.error("\t-Meshlab stages failed: %s", err)
+                n_failed += 1
+                continue
+            for name in generated:
+                logger.info("\t-Generated %s", name)
+            for name, err in failed:
+                logger.error("\t-Failed to generate %s: %s", name, err)
+            n_failed += len(failed)
+    finally:
+        # Also on errors, so no temporary scripts are left behind
+        for future in pending:
+            future.cancel()
+        if pool is not None:
+            pool.shutdown()
+        for tmp_script in (chull_script, simple_script):
+            if tmp_script:
+                os.remove(tmp_script)
+    logger.info("Note: Check chull and simplified meshes for issues!")
+    if n_failed:
+        logger.error("%d meshlab stages failed, see above.", n_failed)
+        sys.exit(1)
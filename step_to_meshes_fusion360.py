@@ -2,78 +2,104 @@
 #Description-Convert all the components in a step file to meshes.
 
 import adsk.core, adsk.fusion, adsk.cam, traceback
-import os.path
-from  os import mkdir
+import os
 import csv
-import math
+import shutil
+from math import sqrt, atan2, copysign
+
+PLACEMENTS_HEADER = ("Label", "x [m]", "y [m]", "z [m]", "axis_x", "axis_y", "axis_z", "angle")
+
 
 def rotation_to_axis_angle(r00, r01, r02,
                            r10, r11, r12,
                            r20, r21, r22):
     """Takes a transform and produces the axis angle associated with the rotation.
     returns: angle, axis_x, axis_y, axis_z"""
-    # based on http://www.euclideanspace.com/maths/geometry/rotations/conversions/matrixToAngle/index.htm
-    epsilon = 0.00001
-    if abs(r01-r10) < epsilon and abs(r02-r20) < epsilon and abs(r12 - r21) < epsilon:
-        # Singularity
-        if abs(r01+r10 < 2*epsilon) and abs(r02 + r20) < 2*epsilon and abs(r12 + r21) < epsilon and abs(r00+r11+r22-3) < epsilon:
-            # Zero angle singularity
-            return 0.,1.,0.,0.
-        else:
-            # 180 degree angle singularity
-            xx = (r00+1)/2.
-            yy = (r11+1)/2.
-            zz = (r22+1)/2.
-            xy = (r01+r10)/4.
-            xz = (r02+r20)/4.
-            yz = (r12+r21)/4.
-            if ((xx > yy) and (xx > zz)):
-                if (xx< epsilon):
-                    x = 0.
-                    y = 0.7071
-                    z = 0.7071
-                else:
-                    x = math.sqrt(xx)
-                    y = xy/x
-                    z = xz/x
-            elif (yy > zz):
-                if (yy< epsilon):
-                    x = 0.7071
-                    y = 0.
-                    z = 0.7071
-                else:
-                    y = math.sqrt(yy)
-                    x = xy/y
-                    z = yz/y
-            else:
-                if (zz< epsilon):
-                    x = 0.7071
-                    y = 0.7071
-                    z = 0.0
-                else:
-                    z = math.sqrt(zz)
-                    x = xz/z
-                    y = yz/z
-            return math.pi, x, y, z
-    s = math.sqrt((r21 - r12)*(r21 - r12) + (r02 - r20)*(r02 - r20) + (r10 - r01)*(r10 - r01))
-    if (abs(s) < epsilon):
-        s = 1
-    angle = math.acos(( r00 + r11 + r22 - 1)/2)
-    x = (r21 - r12)/s
-    y = (r02 - r20)/s
-    z = (r10 - r01)/s
-    return angle, x, y, z
+    # Pure translations are the common case, the diagonal of a rotation
+    # only sums to 3 for the identity. The tolerance is kept tight since a
+    # diagonal error e hides an angle of about sqrt(2*e).
+    if abs(r00 - 1.) + abs(r11 - 1.) + abs(r22 - 1.) < 1e-12:
+        return 0., 1., 0., 0.
+    # Goes through the quaternion, using the largest of the trace and the
+    # diagonal elements to stay well conditioned, based on
+    # http://www.euclideanspace.com/maths/geometry/rotations/conversions/matrixToQuaternion/index.htm
+    tr = r00 + r11 + r22
+    if tr > 0:
+        s = sqrt(tr + 1.)*2  # s = 4*qw
+        qw = 0.25*s
+        qx = (r21 - r12)/s
+        qy = (r02 - r20)/s
+        qz = (r10 - r01)/s
+    else:
+        # Largest diagonal element i, with j and k the next axes in cyclic order
+        r = ((r00, r01, r02), (r10, r11, r12), (r20, r21, r22))
+        i = max(range(3), key=lambda d: r[d][d])
+        j, k = (i + 1) % 3, (i + 2) % 3
+        s = sqrt(1. + r[i][i] - r[j][j] - r[k][k])*2  # s = 4*q[i]
+        q = [0., 0., 0.]
+        q[i] = 0.25*s
+        q[j] = (r[j][i] + r[i][j])/s
+        q[k] = (r[k][i] + r[i][k])/s
+        qw = (r[k][j] - r[j][k])/s
+        qx, qy, qz = q
+    n = sqrt(qx*qx + qy*qy + qz*qz)
+    if n < 1e-12:
+        # Zero angle, any axis will do
+        return 0., 1., 0., 0.
+    # Keep the angle in [0, pi] by flipping the axis with the sign of qw
+    angle = 2*atan2(n, abs(qw))
+    sgn = copysign(1., qw)
+    return angle, sgn*qx/n, sgn*qy/n, sgn*qz/n
 
 
 def transform_to_xyz_angle_axis(transf):
     """Takes a transform and produces the displacement and quaternion associated with it"""
-    angle, axis_x, axis_y, axis_z = rotation_to_axis_angle(transf.getCell(0,0), transf.getCell(0,1), transf.getCell(0,2),
-                                                           transf.getCell(1,0), transf.getCell(1,1), transf.getCell(1,2),
-                                                           transf.getCell(2,0), transf.getCell(2,1), transf.getCell(2,2))
-    x, y, z = transf.getCell(0,3), transf.getCell(1,3), transf.getCell(2,3)
+    # All 16 cells row-major in one API call instead of 12 getCell calls
+    cells = transf.asArray()
+    angle, axis_x, axis_y, axis_z = rotation_to_axis_angle(cells[0], cells[1], cells[2],
+                                                           cells[4], cells[5], cells[6],
+                                                           cells[8], cells[9], cells[10])
+    x, y, z = cells[3], cells[7], cells[11]
     return x, y, z, angle, axis_x, axis_y, axis_z
 
 
+def is_flat_sided(component):
+    """Checks if all faces of the component are planes bounded by straight edges.
+    Such a component tessellates to the same surface at every mesh refinement."""
+    bodies = list(component.bRepBodies)
+    for occ in component.allOccurrences:
+        bodies.extend(occ.bRepBodies)
+    for body in bodies:
+        for face in body.faces:
+            if face.geometry.surfaceType != adsk.core.SurfaceTypes.PlaneSurfaceType:
+                return False
+        for edge in body.edges:
+            if edge.geometry.curveType != adsk.core.Curve3DTypes.Line3DCurveType:
+                return False
+    return True
+
+
+def saved_version(document):
+    """Identifies the saved version of the document.
+    returns: "id:version", or None if the document has unsaved changes"""
+    if not document.isSaved or document.isModified:
+        return None
+    dataFile = document.dataFile
+    return "{}:{}".format(dataFile.id, dataFile.versionNumber)
+
+
+def meshes_up_to_date(componentpath, version):
+    """Checks if the meshes in componentpath were exported from this version of the document."""
+    stamppath = os.path.join(componentpath, "meshes.stamp")
+    if version is None or not os.path.exists(stamppath):
+        return False
+    for name in ("simple.stl", "full.stl"):
+        if not os.path.exists(os.path.join(componentpath, name)):
+            return False
+    with open(stamppath, "r") as stampfile:
+        return stampfile.read() == version
+
+
 def run(context):
     ui = None
     try:
@@ -93,41 +119,55 @@ def run(context):
             components = design.allComponents
             exportMgr = design.exportManager
             nComponents = len(components)
+            # Group all occurrences by component in one pass over the assembly
+            occurrencesByComponent = {}
+            for occ in rootComponent.allOccurrences:
+                occurrencesByComponent.setdefault(occ.component.id, []).append(occ)
+            # Meshes from the same saved version don't need exporting again
+            version = saved_version(product)
             # Create progressbar
             for component in components:
-                # Count the number of occurrences
-                occurrences = rootComponent.allOccurrencesByComponent(component)
-                nOccurrences = len(occurrences)
-                # No occurrence? Then we skip this
-                if nOccurrences == 0:
+                # No occurrence? Then we skip this before touching the disk
+                occurrences = occurrencesByComponent.get(component.id)
+                if not occurrences:
                     continue
                 # Make sure the component folder exists
                 componentpath = os.path.join(meshpath, component.name)
-                if not os.path.exists(componentpath):
-                    os.mkdir(componentpath)
-                # Create the placements.csv file
+                os.makedirs(componentpath, exist_ok=True)
                 placepath = os.path.join(componentpath, "placements.csv")
-                with open(placepath, "w") as csvfile:
+                simplepath = os.path.join(componentpath, "simple")
+                fullpath = os.path.join(componentpath, "full")
+                # Get xyz and axis-angle of all occurrences before writing
+                rows = []
+                for occ in occurrences:
+                    x, y, z, angle, axis_x, axis_y, axis_z = transform_to_xyz_angle_axis(occ.transform)
+                    rows.append([occ.name.replace(":","__"),
+                                 x,y,z,
+                                 axis_x,axis_y,axis_z,angle])
+                # Create the placements.csv file
+                with open(placepath, "w", 1 << 16, newline="") as csvfile:
                     csvwrtr = csv.writer(csvfile, delimiter=",")
-                    csvwrtr.writerow(["Label", "x [m]", "y [m]", "z [m]", "axis_x", "axis_y", "axis_z", "angle"])
-                    for occ in occurrences:
-                        # Get xyz and axis-angle 
-                        x, y, z, angle, axis_x, axis_y, axis_z = transform_to_xyz_angle_axis(occ.transform)
-                        csvwrtr.writerow([occ.name.replace(":","__"),
-                                          x,y,z,
-                                          axis_x,axis_y,axis_z,angle])
-                        
+                    csvwrtr.writerow(PLACEMENTS_HEADER)
+                    csvwrtr.writerows(rows)
+                if meshes_up_to_date(componentpath, version):
+                    continue
 
                 # Create the simple.stl
-                stlOptions = exportMgr.createSTLExportOptions(component, os.path.join(componentpath, "simple"))
+                stlOptions = exportMgr.createSTLExportOptions(component, simplepath)
                 stlOptions.sendToPrintUtility = False
                 stlOptions.meshRefinement = 2  # 0 = High, 1 = Medium, 2 = Low mesh refinement
                 exportMgr.execute(stlOptions)
-                # Create the full.stl
-                stlFullOptions = exportMgr.createSTLExportOptions(component, os.path.join(componentpath, "full"))
-                stlFullOptions.sendToPrintUtility = False
-                stlFullOptions.meshRefinement = 1
-                exportMgr.execute(stlFullOptions)
+                # Create the full.stl, flat sided parts don't get any finer
+                if is_flat_sided(component):
+                    shutil.copyfile(simplepath + ".stl", fullpath + ".stl")
+                else:
+                    # Same options, only the file and refinement differ
+                    stlOptions.filename = fullpath
+                    stlOptions.meshRefinement = 1
+                    exportMgr.execute(stlOptions)
+                if version is not None:
+                    with open(os.path.join(componentpath, "meshes.stamp"), "w") as stampfile:
+                        stampfile.write(version)
         else:
             exit
     except: